@@ -1,19 +1,36 @@
 import sys
 import numpy as np
-from signal import localmax_climb, slices, cross_corr, hz2bpm
+from signal import localmax_climb, slices, sliding_windows, batched_cross_corr, hz2bpm
 import matplotlib.pyplot as plt
+from scipy.fftpack import next_fast_len
+from scipy.ndimage import binary_dilation
 from .heartseries import Series, HeartSeries
-from sklearn.linear_model import TheilSenRegressor
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, the jitted helpers below also run as plain python (just slower)
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 
 from ishneholterlib import Holter
 from heartseries import Series
 
-from quality import sqi_slices, sig_pad
+from quality import sqi_slices
 from envelope import envelopes_perc_threshold, envelopes_at_perc
-from envelope import beat_penalty_threshold, beat_penalty
+from envelope import beat_penalty_threshold, beat_penalty_batch
+
 
-from signal import cross_corr
+def kim_normalize(sig):
+    """adjust distribution to the one Kim has optimized for. Modifies sig in-place (no temporary arrays), and returns it."""
+    mean, std = np.mean(sig), np.std(sig)
+    np.subtract(sig, mean, out=sig)
+    np.multiply(sig, 0.148213 / std, out=sig)
+    np.subtract(sig, 0.191034, out=sig)
+    return sig
 
 
 class NoisyECG(object):
@@ -44,13 +61,15 @@ class NoisyECG(object):
         return bpm_ok and enough_beats and beat_hist_ok
 
     def slice_good(self, sl, median_beat):
-        spectrum = np.abs(np.fft.fft(sl)**2)
+        """:param sl: a single slice, or a 2d array of slices (one per row). :returns bool (array) verdict"""
+        L = next_fast_len(sl.shape[-1])  # zero-pad to a fast FFT size (slices have odd length)
+        spectrum = np.abs(np.fft.rfft(sl, L, axis=-1))**2  # one batched FFT, bins [0, L//2] of the full FFT
 
         # around 1/8, there is a bottom in a clean signal (see plot of mean beat spectrum)
-        lf_hf_db = 10.0 * np.log10(np.sum(spectrum[0:len(spectrum)//8]) / np.sum(spectrum[len(spectrum)//8:len(spectrum)//2]))
+        lf_hf_db = 10.0 * np.log10(np.sum(spectrum[..., 0:L//8], axis=-1) / np.sum(spectrum[..., L//8:L//2], axis=-1))
 
         # the slice has similar power like the median_beat
-        power_ratio_db = 10.0 * np.log10(np.sum(sl**2) / np.sum(median_beat**2))
+        power_ratio_db = 10.0 * np.log10(np.sum(sl**2, axis=-1) / np.sum(median_beat**2))
 
         if False:
             plt.plot(spectrum, c='r')
@@ -60,9 +79,9 @@ class NoisyECG(object):
             plt.show()
 
         # the slice has similar power like the median_beat
-        power_similar = -6.0 < power_ratio_db < 6.0  # 10 dB is a bit lenient. 6 dB would be better, but some baseline drift is larger.
+        power_similar = (-6.0 < power_ratio_db) & (power_ratio_db < 6.0)  # 10 dB is a bit lenient. 6 dB would be better, but some baseline drift is larger.
 
-        return lf_hf_db > 5.0 and power_similar
+        return (lf_hf_db > 5.0) & power_similar
 
     def beat_detect(self, debug=False, outlierthreshold=0.001):
         # Heuristics:
@@ -79,26 +98,17 @@ class NoisyECG(object):
         #
         # Kim ECG beat detection
         #
-        smoothsignal = np.array(ecg.x)
+        smoothsignal = np.array(ecg.x, dtype=float)  # own float copy, normalized in-place below
         
-        # kill outliers
+        # kill outliers: clip where only an outlierthreshold fraction of samples lies outside +/- m
         mn, mx = np.min(smoothsignal), np.max(smoothsignal)
-        m = min(abs(mn),abs(mx))
-        N = 100
-        step = m/float(N)
-        for i in range(N):
-            n = len(np.where(smoothsignal<-m)[0]) + len(np.where(smoothsignal>m)[0])
-            if n > outlierthreshold*len(smoothsignal):
-                break
-            m -= step
-        mn, mx = -m, m
-
-        smoothsignal[smoothsignal<mn] = mn
-        smoothsignal[smoothsignal>mx] = mx
+        absx = np.abs(smoothsignal)
+        k = len(absx) - int(outlierthreshold*len(absx)) - 1
+        m = min(np.partition(absx, k)[k], abs(mn), abs(mx))  # O(N) quantile selection, instead of a threshold search
+        np.clip(smoothsignal, -m, m, out=smoothsignal)
         smoothsignal[-10:] = 0 # extreme outlier in last few frames
         
-        # adjust distribution to the one Kim has optimized for
-        smoothsignal = (smoothsignal-np.mean(smoothsignal))/np.std(smoothsignal)*0.148213-0.191034
+        kim_normalize(smoothsignal)
         loc, beattime = self.QRSdetection(smoothsignal, ecg.fps, ecg.t, ftype=0)
         loc = loc.flatten()
 
@@ -109,22 +119,26 @@ class NoisyECG(object):
         peak_errs = (new_loc - loc) / float(ecg.fps)
         #print 'np.mean(peak_errs), np.std(peak_errs)', np.mean(peak_errs), np.std(peak_errs)
 
-        ibis = np.diff(loc / float(ecg.fps))
-        median_ibi = np.median(ibis)
+        median_ibi_samples = np.median(np.diff(loc))  # stay in (integer) samples, convert only the result
+        median_ibi = median_ibi_samples / float(ecg.fps)
 
         #
         # filter beats by cross-correlation with median beat
         #
-        ecg_slices = np.array(slices(ecg.x, loc, hwin=int(np.ceil(median_ibi * ecg.fps))//2))
+        ecg_slices = np.array(slices(ecg.x, loc, hwin=int(np.ceil(median_ibi_samples))//2))
         # median value from each timepoint (not a single one of any of the beats)
-        median_beat = np.median(ecg_slices, axis=0)
+        n = len(ecg_slices)
+        if n % 2 == 1:
+            median_beat = np.partition(ecg_slices, n//2, axis=0)[n//2]  # odd n: the middle element, nothing to average
+        else:
+            median_beat = np.median(ecg_slices, axis=0)
         if debug:
             plt.plot(np.arange(len(median_beat))/float(ecg.fps), median_beat)
             plt.title('median ECG beat')
-        cross_corrs = [cross_corr(sl, median_beat) for sl in ecg_slices]
+        cross_corrs = batched_cross_corr(ecg_slices, median_beat)
 
-        spectrum_ok = np.array([self.slice_good(sl, median_beat) for sl in ecg_slices])
-        ccs_ok = np.array(cross_corrs) > NoisyECG.GOOD_BEAT_THRESHOLD
+        spectrum_ok = self.slice_good(ecg_slices, median_beat)
+        ccs_ok = cross_corrs > NoisyECG.GOOD_BEAT_THRESHOLD
 
         good_loc_idxs = np.where(ccs_ok & spectrum_ok)[0]
         if debug:
@@ -164,12 +178,12 @@ class NoisyECG(object):
 def baseline_energy(ecg):
     """The lowest energy level in dB(1) (should be where ECG signal is)."""
     sll = int(ecg.fps*1.0)  # slice len
-    idxs = np.arange(0, len(ecg.x)-sll, sll)
-    slices = [ecg.x[i:i+sll] for i in idxs]
-    #btt = idxs / float(ecg.fps)
-    energies = [10.0*np.log10(np.mean(sl**2)) for sl in slices]
-    energies_hist = list(sorted(energies))
-    return np.mean(energies_hist[:5])  # at least 5 clean ECG beats should be there, hopefully
+    n = max(len(ecg.x) - 1, 0) // sll  # same slices as np.arange(0, len(ecg.x)-sll, sll)
+    slicez = np.reshape(ecg.x[:n*sll], (n, sll))
+    energies = 10.0*np.log10(np.mean(slicez**2, axis=1))
+    k = min(5, len(energies))  # at least 5 clean ECG beats should be there, hopefully
+    lowest = np.partition(energies, k-1)[:k] if k > 0 else energies  # no need to fully sort
+    return np.mean(lowest)
 
 
 def scrub_ecg(ecg_in, THRESHOLD = 8.0):
@@ -180,27 +194,27 @@ def scrub_ecg(ecg_in, THRESHOLD = 8.0):
     """
     #ecg = ecg_in.copy()
     #THRESHOLD = 8.0  # dB above baseline_energy()
-    ecg = Series(ecg_in.x, ecg_in.fps, ecg_in.lpad)
+    ecg = Series(ecg_in.x, ecg_in.fps, ecg_in.lpad)  # nb. Series() copies x, so ecg_in is left untouched
     #ecg.x = highpass(ecg.x, fps=ecg.fps, cf=2.0, tw=0.4)
     baseline_db = baseline_energy(ecg)
     hwin = int(ecg.fps*0.5)
-    check_centers = np.arange(hwin, len(ecg.x)-hwin+1, int(ecg.fps*0.1))  # more densely spaced than hwin
-    verdict = []
-    for c in check_centers:
-        sl = ecg.x[c-hwin:c+hwin+1]
-        energy_db = 10.0*np.log10(np.mean(sl**2))
-        verdict.append(energy_db < baseline_db + THRESHOLD)
-
-    good_locs = np.where(verdict)[0]
+    step = int(ecg.fps*0.1)  # more densely spaced than hwin
+    windows = sliding_windows(ecg.x, 2*hwin+1, step)
+    check_centers = hwin + step * np.arange(len(windows))
+    energies_db = 10.0*np.log10(np.einsum('ij,ij->i', windows, windows) / windows.shape[1])
+    verdict = energies_db < baseline_db + THRESHOLD
+
     #flood_fill_width = int(ecg.fps*0.8)
     flood_fill_width = 5  # cf. check_centers step size
-    for i in good_locs:
-        for j in range(max(i - flood_fill_width, 0), min(i + flood_fill_width + 1, len(verdict))):
-            verdict[j] = True
+    verdict = binary_dilation(verdict, structure=np.ones(2*flood_fill_width+1, dtype=bool))
 
-    for c, v in zip(check_centers, verdict):
-        if not v:
-            ecg.x[c-hwin:c+hwin+1] *= 0.0  # zero the noisy bits
+    # mark the windows around noisy centers as +1/-1 boundaries, so a cumsum covers all their samples
+    noisy_centers = check_centers[~verdict]
+    boundaries = np.zeros(len(ecg.x) + 1, dtype=int)
+    np.add.at(boundaries, noisy_centers - hwin, 1)
+    np.add.at(boundaries, noisy_centers + hwin + 1, -1)
+    noisy = np.cumsum(boundaries[:-1]) > 0
+    ecg.x[noisy] *= 0.0  # zero the noisy bits
 
     #ecg.x = np.clip(ecg.x, np.mean(ecg.x) - 10*np.std(ecg.x), np.mean(ecg.x) + 10*np.std(ecg.x))
 
@@ -216,9 +230,7 @@ def beatdet_ecg(ecg_in):
     @see beatdet_alivecor(signal, fps=48000, lpad_t=0) in hsh_signal.alivecor
     """
     from kimqrsdetector.kimqrsdetector import QRSdetection
-    smoothsignal = ecg_in.x
-    # adjust distribution to the one Kim has optimized for
-    smoothsignal = (smoothsignal-np.mean(smoothsignal))/np.std(smoothsignal)*0.148213-0.191034
+    smoothsignal = kim_normalize(np.array(ecg_in.x, dtype=float))
     loc, beattime = QRSdetection(smoothsignal, ecg_in.fps, ecg_in.t, ftype=0)
     loc = loc.flatten()
     return HeartSeries(ecg_in.x, loc, fps=ecg_in.fps)
@@ -228,31 +240,79 @@ def ecg_snr(raw, fps):
     """SNR of AliveCor ECG in raw audio. For quick (0.5 sec) checking whether audio contains ECG or not."""
     win_size = int(2.0*fps)  # 2sec window
     f1 = float(fps) / float(win_size)  # FFT frequency spacing
-    power_ecg, power_noise = 0.0, 0.0
-    for sl in range(0,len(raw)-win_size,win_size):
-        slf = np.fft.fft(raw[sl:sl+win_size])
-        # power in the AliveCor band (18.8 kHz)
-        ecg_band = slf[int(18000/f1):int(19600/f1)]
-        # compared to high-freq baseline noise
-        noise_band = slf[int(16000/f1):int(17600/f1)]
-        pe, pn = np.sqrt(np.sum(np.abs(ecg_band)**2)) / len(ecg_band), np.sqrt(np.sum(np.abs(noise_band)**2)) / len(noise_band)
-        power_ecg += pe
-        power_noise += pn
+    nwin = max(len(raw) - 1, 0) // win_size  # same windows as range(0, len(raw)-win_size, win_size)
+    if nwin == 0:
+        return -10.0  # nothing? pretend bad SNR
+    # all windows in one batched FFT
+    slf = np.fft.rfft(np.reshape(raw[:nwin*win_size], (nwin, win_size)), axis=1)
+    # power in the AliveCor band (18.8 kHz)
+    ecg_band = slf[:, int(18000/f1):int(19600/f1)]
+    # compared to high-freq baseline noise
+    noise_band = slf[:, int(16000/f1):int(17600/f1)]
+    pe = np.sqrt(np.sum(ecg_band.real**2 + ecg_band.imag**2, axis=1)) / ecg_band.shape[1]
+    pn = np.sqrt(np.sum(noise_band.real**2 + noise_band.imag**2, axis=1)) / noise_band.shape[1]
+    power_ecg, power_noise = np.sum(pe), np.sum(pn)
     # nb. division removes const factor of #windows
     if power_noise == 0.0 and power_ecg == 0.0:
         return -10.0  # nothing? pretend bad SNR
     return 20.0 * np.log10(power_ecg / power_noise)
 
 
+@njit(cache=True, boundscheck=True)
+def find_flanks(x, i, slopesize):
+    """:returns (up_start, up_end, down_start, down_end) of the up/down slope flanks around peak index i."""
+    up_start = i
+    while x[up_start] >= x[i] and up_start > i - slopesize: # make sure start is in trough, not still on peak / plateau
+        up_start -= 1
+    up_start -= slopesize
+    while x[up_start + 1] <= x[up_start] and up_start < i - 1: # climb past noise (need to go up)
+        up_start += 1
+    up_end = i + 2
+    while x[up_end - 1] >= x[up_end] and up_end > i + 1: # climb past noise (need to go up)
+        up_end -= 1
+
+    down_start = i
+    down_end = i
+    while x[down_end] >= x[i] and down_end < i + slopesize: # make sure end is in trough, not still on peak / plateau
+        down_end += 1
+    down_end += slopesize
+    while x[down_start + 1] >= x[down_start] or x[down_start + 2] >= x[down_start] and down_start < down_end: # climb past noise (need to go down)
+        down_start += 1
+    while x[down_end - 1] <= x[down_end] and down_end > down_start: # climb past noise (need to go down)
+        down_end -= 1
+
+    return up_start, up_end, down_start, down_end
+
+
+@njit(cache=True, boundscheck=True)
+def theilsen(t, x):
+    """Theil-Sen line fit x ~ k*t + d via the median of pairwise slopes. :returns (k, d)"""
+    n = len(t)
+    slopes = np.empty(n * (n - 1) // 2)
+    m = 0
+    for a in range(n):
+        for b in range(a + 1, n):
+            slopes[m] = (x[b] - x[a]) / (t[b] - t[a])
+            m += 1
+    k = np.median(slopes)
+    d = np.median(x - k * t)
+    return k, d
+
+
 def fix_ecg_peaks(ecg, plt=None):
     ecg = ecg.copy()
 
     slopesize = int(ecg.fps / 45.0)
 
     # climb to maxima, and invert if necessary
-    ecgidx = [max(i - slopesize, 0) + np.argmax(ecg.x[max(i - slopesize, 0):min(i + slopesize, len(ecg.x) - 1)]) for i in ecg.ibeats]
+    # windows ecg.x[i-slopesize:i+slopesize] (clipped to [0, len-1)) are rows of strided views, padded to never win
+    ibeats = np.asarray(ecg.ibeats).astype(int)
+    x = np.asarray(ecg.x[:-1], dtype=float)  # float, so the +/-inf padding survives for integer signals
+    xlo = np.pad(x, (slopesize, slopesize + 1), mode='constant', constant_values=-np.inf)
+    xhi = np.pad(x, (slopesize, slopesize + 1), mode='constant', constant_values=np.inf)
+    ecgidx = ibeats - slopesize + np.argmax(sliding_windows(xlo, 2*slopesize)[ibeats], axis=1)
     beatheight = np.mean(ecg.x[ecgidx]) - np.mean(ecg.x) # average detected beat amplitude
-    negecgidx = [max(i - slopesize, 0) + np.argmin(ecg.x[max(i - slopesize, 0):min(i + slopesize, len(ecg.x) - 1)]) for i in ecg.ibeats]
+    negecgidx = ibeats - slopesize + np.argmin(sliding_windows(xhi, 2*slopesize)[ibeats], axis=1)
     negbeatheight = np.mean(ecg.x[negecgidx]) - np.mean(ecg.x)  # average detected beat amplitude in the other direction
     if np.abs(negbeatheight) > np.abs(beatheight): # if the other direction has "higher" peaks, invert signal
         ecg.x *= -1
@@ -266,26 +326,8 @@ def fix_ecg_peaks(ecg, plt=None):
     fixed_indices, fixed_times = [], []
     # loop through and linearly interpolate peak flanks
     for i in ecgidx:
-        up_start = i
-        while ecg.x[up_start] >= ecg.x[i] and up_start > i - slopesize: # make sure start is in trough, not still on peak / plateau
-            up_start -= 1
-        up_start -= slopesize
-        while ecg.x[up_start + 1] <= ecg.x[up_start] and up_start < i - 1: # climb past noise (need to go up)
-            up_start += 1
-        up_end = i + 2
-        while ecg.x[up_end - 1] >= ecg.x[up_end] and up_end > i + 1: # climb past noise (need to go up)
-            up_end -= 1
+        up_start, up_end, down_start, down_end = find_flanks(ecg.x, int(i), slopesize)
         upidx = np.arange(up_start, up_end) # indices of upslope
-
-        down_start = i
-        down_end = i
-        while ecg.x[down_end] >= ecg.x[i] and down_end < i + slopesize: # make sure end is in trough, not still on peak / plateau
-            down_end += 1
-        down_end += slopesize
-        while ecg.x[down_start + 1] >= ecg.x[down_start] or ecg.x[down_start + 2] >= ecg.x[down_start] and down_start < down_end: # climb past noise (need to go down)
-            down_start += 1
-        while ecg.x[down_end - 1] <= ecg.x[down_end] and down_end > down_start: # climb past noise (need to go down)
-            down_end -= 1
         downidx = np.arange(down_start, down_end) # indices of downslope
 
         if len(ecg.t[upidx]) <= 1 or len(ecg.t[downidx]) <= 1: # one or both flanks missing. just use max
@@ -293,10 +335,8 @@ def fix_ecg_peaks(ecg, plt=None):
             bestt = ecg.t[i]
         else:
             # interpolate flanks
-            model1 = TheilSenRegressor().fit(ecg.t[upidx].reshape(-1, 1), ecg.x[upidx])
-            model2 = TheilSenRegressor().fit(ecg.t[downidx].reshape(-1, 1), ecg.x[downidx])
-            k1, d1 = model1.coef_[0], model1.intercept_
-            k2, d2 = model2.coef_[0], model2.intercept_
+            k1, d1 = theilsen(ecg.t[upidx], ecg.x[upidx])
+            k2, d2 = theilsen(ecg.t[downidx], ecg.x[downidx])
             angle1, angle2 = np.arctan(k1), np.arctan(k2)
             if False:
                 pass
@@ -327,8 +367,8 @@ def fix_ecg_peaks(ecg, plt=None):
             plt.plot(ecg.t[downidx], ecg.x[downidx], 'm')
 
             if len(upidx) > 1 and len(downidx) > 1:
-                plt.plot(ecg.t[upidx], model1.predict(ecg.t[upidx].reshape(-1, 1)), '--k')
-                plt.plot(ecg.t[downidx], model2.predict(ecg.t[downidx].reshape(-1, 1)), '--y')
+                plt.plot(ecg.t[upidx], k1 * ecg.t[upidx] + d1, '--k')
+                plt.plot(ecg.t[downidx], k2 * ecg.t[downidx] + d2, '--y')
 
             plt.scatter(ecg.t[reali], ecg.x[reali], 60, 'r')
             plt.scatter(bestt, ecg.x[reali], 90, 'k')
@@ -358,7 +398,11 @@ def ecg_kept(raw):
 
     slicez = sqi_slices(ecg, method='fixed', slice_front=0.5, slice_back=-0.5)
     L = max([len(sl) for sl in slicez])
-    padded_slicez = np.array([sig_pad(sl, L, side='center', mode='constant') for sl in slicez])
+    # same as sig_pad(sl, L, side='center', mode='constant') for each slice, written into one preallocated array
+    padded_slicez = np.zeros((len(slicez), L))
+    for i, sl in enumerate(slicez):
+        front = (L - len(sl)) // 2
+        padded_slicez[i, front:front+len(sl)] = sl
 
     ###
 
@@ -368,14 +412,14 @@ def ecg_kept(raw):
 
     bpt = beat_penalty_threshold(le, ue, mb)
 
-    bps = np.array([beat_penalty(sl, le, ue, mb) for sl in padded_slicez])
+    bps = beat_penalty_batch(padded_slicez, le, ue, mb)
 
     bp_ok = bps < bpt
 
     ###
 
-    template = np.median(padded_slicez, axis=0)
-    corrs = np.array([cross_corr(sl, template) for sl in padded_slicez])
+    template = mb  # same median beat as above
+    corrs = batched_cross_corr(padded_slicez, template)
 
     CORR_THRESHOLD = 0.8
     corr_ok = corrs > CORR_THRESHOLD
@@ -84,6 +84,14 @@ def beat_penalty(sl, le, ue, mb, debug=False):
     return penalty / median_energy
 
 
+def beat_penalty_batch(slicez, le, ue, mb):
+    """beat_penalty() of each row of the 2d array slicez, all at once."""
+    out_of_envelope = (slicez > ue) | (slicez < le)
+    penalty = np.sqrt(np.mean(out_of_envelope * (slicez - mb) ** 2, axis=1))
+    median_energy = np.sqrt(np.mean(mb ** 2))
+    return penalty / median_energy
+
+
 def beat_penalty_threshold(le, ue, mb, debug=False):
     # idea: set threshold for noisy beats where a beat always eps above the normal percentile envelope
     # would be penalized.
@@ -1,11 +1,29 @@
 from __future__ import division
 
 import numpy as np
-from .signal import filter_fft_ff
+from .signal import filter_fft_taps, filter_fft_padded_len, overlap_save
 from .iter import pairwise
 import time
 
 
+_fir_designs = {}
+
+
+def fir_design(design, *args):
+    """
+    Memoized filter design from gr_firdes, e.g. fir_design('low_pass_2', 1, sampling_rate, cutoff_freq, transition_width, 60)
+    Filters tend to be built with the same parameters over and over again, so design each only once.
+
+    :returns (taps, H) where H is the precomputed filter_fft_taps(taps)
+    """
+    key = (design,) + args
+    if key not in _fir_designs:
+        from gr_firdes import firdes
+        taps = getattr(firdes, design)(*args)
+        _fir_designs[key] = (taps, filter_fft_taps(taps))
+    return _fir_designs[key]
+
+
 class FilterBlock(object):
     """Realtime batch-processing filter block interface."""
     def __init__(self):
@@ -41,14 +59,25 @@ class DataSink(SinkBlock):
     """Simply collects the data."""
     def __init__(self, dtype=None):
         super(DataSink, self).__init__()
-        self.data = np.array([], dtype=dtype)
         self.dtype = dtype
+        self.reset()
 
     def put(self, x):
-        self.data = np.concatenate([self.data, x])
+        # just keep (copies of) the batches around, concatenating each time would be quadratic.
+        # copy, since producers may re-use their buffers (or pass on views of them)
+        self._chunks.append(np.array(x))
+
+    @property
+    def data(self):
+        """All data collected so far, as a single array."""
+        if len(self._chunks) != 1 or self._chunks[0] is not self._data:
+            self._data = np.concatenate([np.array([], dtype=self.dtype)] + self._chunks)
+            self._chunks = [self._data]
+        return self._data
 
     def reset(self):
-        self.data = np.array([], dtype=self.dtype)
+        self._chunks = []
+        self._data = None
 
 
 class Delay(FilterBlock):
@@ -56,13 +85,21 @@ class Delay(FilterBlock):
     def __init__(self, delay):
         """:param delay: delay in number of samples"""
         super(Delay, self).__init__()
-        self._buffer = np.zeros(delay)
+        self._buffer = np.zeros(delay)  # the last delay samples, updated in-place
         self.delay = delay
 
     def batch(self, x):
-        self._buffer = np.concatenate([self._buffer, x])
-        y = self._buffer[:-self.delay]
-        self._buffer = self._buffer[-self.delay:]
+        x = np.asarray(x)
+        n, d = len(x), self.delay
+        if not np.can_cast(x.dtype, self._buffer.dtype):
+            self._buffer = self._buffer.astype(np.result_type(self._buffer, x))
+        if n >= d:
+            y = np.concatenate([self._buffer, x[:n-d]])
+            self._buffer[:] = x[n-d:]
+        else:
+            y = self._buffer[:n].copy()
+            self._buffer[:d-n] = self._buffer[n:]
+            self._buffer[d-n:] = x
         return y
 
 
@@ -100,10 +137,11 @@ class FIRFilter(FilterBlock):
     MODE_CONVOLVE = 1
     MODE_FFT_CONVOLVE = 2
 
-    def __init__(self, taps, sampling_rate):
+    def __init__(self, taps, sampling_rate, H=None):
         """
         :param taps:          filter impulse response
         :param sampling_rate: sampling rate (Hz)
+        :param H:             optional precomputed filter_fft_taps(taps)
         """
         super(FIRFilter, self).__init__()
         self._taps = taps  # filter impulse response
@@ -111,7 +149,9 @@ class FIRFilter(FilterBlock):
         self._ntaps = len(self._taps)
         self._ntaps_front = self._ntaps // 2
         self._ntaps_back = self._ntaps - self._ntaps_front  # for odd ntaps, +1 at the back
+        # input buffer, re-used for every batch: trailing ntaps-1 samples of the previous batch, then the current batch
         self._buffer_x = np.zeros(self._ntaps - 1)
+        self._H = filter_fft_taps(self._taps) if H is None else H  # filter spectrum, computed once instead of every batch
         self.mode = FIRFilter.MODE_FFT_CONVOLVE
 
     @property
@@ -119,24 +159,38 @@ class FIRFilter(FilterBlock):
         """Filter delay in number of samples."""
         return self._ntaps_front
 
+    def _reserve(self, n):
+        """grow the input buffer if necessary, to hold a batch of n samples (plus FFT end padding)"""
+        overlap = self._ntaps - 1
+        need = filter_fft_padded_len(n, self._ntaps)
+        if len(self._buffer_x) < need:
+            buf = np.zeros(need)
+            buf[:overlap] = self._buffer_x[:overlap]
+            self._buffer_x = buf
+        return need
+
     def batch(self, x):
         """batch-process an array and return array of output values"""
-        self._buffer_x = np.concatenate([self._buffer_x, x])
+        n, overlap = len(x), self._ntaps - 1
+        end = self._reserve(n)
+        buf = self._buffer_x
+        buf[overlap:overlap+n] = np.real(x)
 
         # filter a slightly longer batch, to avoid boundary effects
         #print('len(self._buffer_x)=', len(self._buffer_x), 'len(self._taps)=', len(self._taps))
         #Logger.info(str(('len(self._buffer_x)=', len(self._buffer_x), 'len(self._taps)=', len(self._taps))))
         if self.mode == FIRFilter.MODE_CONVOLVE:
             # slow. for testing only
-            filtered = np.convolve(self._buffer_x, self._taps, mode='valid')
+            filtered = np.convolve(buf[:overlap+n], self._taps, mode='valid')
             #filtered *= 0.1
         elif self.mode == FIRFilter.MODE_FFT_CONVOLVE:
-            filtered = filter_fft_ff(self._buffer_x, self._taps)
+            buf[overlap+n:end] = 0.0  # end padding for the last FFT block
+            filtered = overlap_save(buf[:end], n, self._ntaps, self._H)
         else:
             raise ValueError('invalid FIRFilter mode')
 
-        # trim buffer: just keep trailing bit to include it into leading boundary of next batch
-        self._buffer_x = self._buffer_x[-self._ntaps+1:]
+        # just keep trailing bit to include it into leading boundary of next batch
+        buf[:overlap] = buf[n:n+overlap]
 
         # cut off leading/trailing boundary effect areas
         # (note: introduces a delay of self.iphase)
@@ -151,8 +205,8 @@ class HilbertImag(FIRFilter):
         :param ntaps   number of taps, made odd if necessary
         """
         ntaps += 1 - ntaps % 2  # ensure taps is odd
-        from gr_firdes.firdes import hilbert
-        super(HilbertImag, self).__init__(hilbert(ntaps), None)
+        taps, H = fir_design('hilbert', ntaps)
+        super(HilbertImag, self).__init__(taps, None, H=H)
 
 
 class Hilbert(FilterBlock):
@@ -188,6 +242,15 @@ class Hilbert(FilterBlock):
         #print(len(real), len(imag))
         return real + imag * 1j
 
+    def batch_offline(self, x):
+        """
+        Not realtime: process a complete signal at once, via FFT (one rfft instead of the two filter branches).
+        Returns the analytic signal without delay. Used by apply_filter_offline(..., offline=True).
+        """
+        from scipy.signal import hilbert
+        if len(x) == 0: return np.array([], dtype=complex)
+        return hilbert(x)
+
 
 class Lowpass(FIRFilter):
     """Realtime low-pass filter. Introduces a delay and outputs some initial invalid samples."""
@@ -198,8 +261,8 @@ class Lowpass(FIRFilter):
         :param sampling_rate:      sampling rate (Hz)
         """
         # design filter impulse response
-        from gr_firdes.firdes import low_pass_2
-        super(Lowpass, self).__init__(low_pass_2(1, sampling_rate, cutoff_freq, transition_width, 60), sampling_rate)
+        taps, H = fir_design('low_pass_2', 1, sampling_rate, cutoff_freq, transition_width, 60)
+        super(Lowpass, self).__init__(taps, sampling_rate, H=H)
 
 
 class Highpass(FIRFilter):
@@ -211,8 +274,8 @@ class Highpass(FIRFilter):
         :param sampling_rate:      sampling rate (Hz)
         """
         # design filter impulse response
-        from gr_firdes.firdes import high_pass_2
-        super(Highpass, self).__init__(high_pass_2(1, sampling_rate, cutoff_freq, transition_width, 60), sampling_rate)
+        taps, H = fir_design('high_pass_2', 1, sampling_rate, cutoff_freq, transition_width, 60)
+        super(Highpass, self).__init__(taps, sampling_rate, H=H)
 
 
 class Bandpass(FIRFilter):
@@ -225,8 +288,8 @@ class Bandpass(FIRFilter):
         :param sampling_rate:      sampling rate (Hz)
         """
         # design filter impulse response
-        from gr_firdes.firdes import band_pass_2
-        super(Bandpass, self).__init__(band_pass_2(1, sampling_rate, low_cutoff_freq, high_cutoff_freq, transition_width, 60), sampling_rate)
+        taps, H = fir_design('band_pass_2', 1, sampling_rate, low_cutoff_freq, high_cutoff_freq, transition_width, 60)
+        super(Bandpass, self).__init__(taps, sampling_rate, H=H)
 
 
 class Bandreject(FIRFilter):
@@ -239,8 +302,8 @@ class Bandreject(FIRFilter):
         :param sampling_rate:      sampling rate (Hz)
         """
         # design filter impulse response
-        from gr_firdes.firdes import band_reject_2
-        super(Bandreject, self).__init__(band_reject_2(1, sampling_rate, low_cutoff_freq, high_cutoff_freq, transition_width, 60), sampling_rate)
+        taps, H = fir_design('band_reject_2', 1, sampling_rate, low_cutoff_freq, high_cutoff_freq, transition_width, 60)
+        super(Bandreject, self).__init__(taps, sampling_rate, H=H)
 
     def batch(self, x):
         before = time.time()
@@ -271,13 +334,9 @@ class Downsampler(FilterBlock):
         self.ratio = ratio
         self.waitfor = 0
     def batch(self, x):
-        if len(x) <= self.waitfor:
-            self.waitfor -= len(x)
-            return np.array([])
-        ret = x[self.waitfor + np.arange(0, len(x)-self.waitfor, self.ratio)]
-        self.waitfor = self.ratio - len(x) % self.ratio
-        # TODO: bugged somehow when used through apply_filter()
-        # TODO: waitfor %= self.ratio
+        ret = x[self.waitfor::self.ratio]  # strided view, no copy
+        # samples to skip in the next batch, until the next one is due
+        self.waitfor = (self.waitfor - len(x)) % self.ratio
         return ret
 
 # d=Downsampler(2)
@@ -322,15 +381,28 @@ class RegroupBatches(FilterBlock):
 
 class MixLocalOscillator(FilterBlock):
     """Local oscillator and mixer that mixes its output in."""
+
+    MAX_TABLE_SIZE = 2**20  #: longest carrier period (in samples) to keep as a wavetable
+
     def __init__(self, fps, f0):
         super(MixLocalOscillator, self).__init__()
         self.fps, self.f0 = fps, f0
-        self.t = 0.0
+        self._i = 0  # integer sample counter: the phase does not drift, unlike an accumulated float time
+        self._table = None
+        if float(fps).is_integer() and float(f0).is_integer():
+            # the carrier repeats exactly every fps/gcd(fps, f0) samples, look it up instead of calling sin()
+            period = int(fps) // np.gcd(int(fps), int(f0))
+            if period <= MixLocalOscillator.MAX_TABLE_SIZE:
+                self._table = np.sin(2*np.pi*f0*np.arange(period)/float(fps))
 
     def batch(self, x):
-        t = self.t + np.arange(len(x))/float(self.fps)
-        self.t = t[-1] + 1.0/float(self.fps)
-        carrier = np.sin(2*np.pi*self.f0*t)
+        n = self._i + np.arange(len(x))
+        if self._table is not None:
+            carrier = self._table[n % len(self._table)]
+            self._i = (self._i + len(x)) % len(self._table)
+        else:
+            carrier = np.sin(2*np.pi*((self.f0/float(self.fps)*n) % 1.0))
+            self._i += len(x)
         return x * carrier
 
 
@@ -365,7 +437,36 @@ class ChunkDataSource(SourceBlock):
         return self._i >= len(self._data)
 
 
+def apply_filter_offline(signal, filter, debug=False, batch_size=179200, offline=False):
+    """
+    Run a whole signal through filter.batch() in chunks, without the source/sink machinery of apply_filter().
+    Only for a single FilterBlock whose output is fully determined by batch() (not a chain wired up behind put()).
+
+    :param offline  if True, use the filter's batch_offline() (e.g. Hilbert) on the whole signal at once instead.
+                    Not the same algorithm as batch(), and introduces no delay.
+    """
+    if offline:
+        return filter.batch_offline(signal)
+
+    signal_padded = np.pad(signal, (0, filter.delay), mode='constant')  # pad with trailing zeros to force returning complete ECG
+    out = [np.array([])]
+
+    prev_t = time.time()
+    for s in range(0, len(signal_padded), batch_size):
+        if time.time() > prev_t + 1.0 and debug:
+            print 'progress: {} %'.format(float(s) / len(signal_padded) * 100.0)
+            prev_t = time.time()
+        out.append(filter.batch(signal_padded[s:s+batch_size]))
+
+    return np.concatenate(out)[filter.delay:]  # cut off leading filter delay (contains nonsense output)
+
+
 def apply_filter(signal, filter, debug=False):
+    if not isinstance(filter, SourceBlock):
+        # a plain FilterBlock: skip polling a ChunkDataSource into a DataSink
+        return apply_filter_offline(signal, filter, debug=debug)
+
+    # filter chains (e.g. AlivecorFilter) re-route put() through their inner blocks
     signal_padded = np.pad(signal, (0, filter.delay), mode='constant')  # pad with trailing zeros to force returning complete ECG
     source = ChunkDataSource(data=signal_padded, batch_size=179200, sampling_rate=filter.sampling_rate)
     sink = DataSink()
@@ -4,6 +4,7 @@ import numpy as np
 from scipy import interpolate
 from scipy import signal
 from scipy.interpolate import interp1d
+from scipy.fftpack import next_fast_len
 
 
 def bpm2hz(f_bpm):
@@ -35,34 +36,69 @@ def nextpow2(n):
     return int(2**int(m_i))
 
 
-def filter_fft_ff(sig, taps):
+def filter_fft_len(ntaps):
+    """FFT block length used by filter_fft_ff() for a filter of ntaps."""
+    return next_fast_len(4*(ntaps-1))
+
+
+def filter_fft_taps(taps):
+    """Filter spectrum for filter_fft_ff(). Compute it once to re-use it for many calls with the same taps."""
+    return np.fft.rfft(taps, filter_fft_len(len(taps)))
+
+
+def filter_fft_padded_len(nout, ntaps):
+    """Length of the zero-end-padded signal buffer that overlap_save() needs for nout output samples (whole FFT blocks)."""
+    step_size = filter_fft_len(ntaps) - (ntaps - 1)
+    nblocks = -(-nout // step_size)
+    return nblocks*step_size + ntaps - 1
+
+
+def overlap_save(x, nout, ntaps, H):
+    """
+    Core of filter_fft_ff(), for callers managing their own (reusable) signal buffer.
+
+    :param x      contiguous signal followed by zeros, at least filter_fft_padded_len(nout, ntaps) long
+    :param nout   number of output samples
+    :param ntaps  filter length
+    :param H      filter_fft_taps(taps)
+    """
+    overlap = ntaps - 1
+    N = filter_fft_len(ntaps)
+    step_size = N - overlap
+    nblocks = -(-nout // step_size)
+    if nblocks <= 0:
+        return np.zeros(0)
+    assert len(x) >= nblocks*step_size + overlap
+
+    # all overlapping blocks as a strided view, FFT'd in one go
+    blocks = np.lib.stride_tricks.as_strided(x, shape=(nblocks, N), strides=(step_size*x.strides[0], x.strides[0]))
+    y = np.fft.irfft(np.fft.rfft(blocks, axis=1) * H, N, axis=1)[:, overlap:]
+    # cut back the end padding
+    return y.ravel()[:nout]
+
+
+def filter_fft_ff(sig, taps, H=None):
     """
     Applies a filter to a signal, implementing the overlap-save method (chunk up the signal)
     see https://en.wikipedia.org/wiki/Overlap%E2%80%93save_method
 
     This is equivalent to:  np.convolve(x, taps, mode='valid')  but more efficient for long signals
+
+    :param H  optional precomputed filter_fft_taps(taps)
     """
 
-    assert(len(sig) > len(taps))  # expect a long signal
+    assert(len(sig) >= len(taps) - 1)  # expect a signal at least as long as the filter overlap
     # ^ we could try reversing sig and taps in this case,
     # but the caller would be surprised to get a longer return value than expected
 
-    h = taps
     M = len(taps)
-    overlap = M - 1
-    N = nextpow2(4*overlap)
-    step_size = N - overlap
-    # TODO: keep filter's FFT around (cache it) instead of recomputing it every time. e.g. currently 15 ms (out of 50 ms) just for Bandreject's H
-    H = np.fft.fft(h, N)
-    x = np.concatenate([sig, np.zeros(N)])  # end padding, so the last step_size batch will surely cover the end
-    y = np.zeros(len(x))
-    for pos in range(0, len(x)+1 - N, step_size):
-        #print(pos)
-        yt = np.fft.ifft(np.fft.fft(x[pos:pos+N], N) * H, N)
-        y[pos:pos+step_size] = yt[M-1:N].real
-    # cut back the end padding, and the overlap region where taps hang out of the signal
-    #y = y[:-N-M//2]  # what is wrong with this line??
-    y = y[0:len(sig)-len(taps)+1]
+    H = filter_fft_taps(taps) if H is None else H
+    nout = len(sig) - (M - 1)  # the overlap region where taps hang out of the signal is cut off
+
+    # end padding, so the last step_size batch will surely cover the end
+    x = np.zeros(filter_fft_padded_len(nout, M))
+    x[:len(sig)] = np.real(sig)
+    y = overlap_save(x, nout, M, H)
 
     # if latency is an issue, see "block convolver" (Bill Gardner)
     # here: http://dsp.stackexchange.com/questions/2537/do-fft-based-filtering-methods-add-intrinsic-latency-to-a-real-time-algorithm
@@ -180,6 +216,11 @@ def cross_corr(x, y):
     """normalized cross-correlation of the two signals of same length"""
     return np.sum(x * y) / np.sqrt(np.sum(x**2) * np.sum(y**2))
 
+def batched_cross_corr(slicez, y):
+    """cross_corr() of each row of the 2d array slicez with y, computed as a single matrix-vector product."""
+    slicez = np.asarray(slicez)
+    return np.dot(slicez, y) / np.sqrt(np.einsum('ij,ij->i', slicez, slicez) * np.sum(y**2))
+
 def slices(arr, loc, hwin):
     """Get slices from arr +/- hwin around indexes loc."""
     ret = []
@@ -189,17 +230,20 @@ def slices(arr, loc, hwin):
         ret.append(arrp[lp-hwin:lp+hwin+1])
     return ret
 
+def sliding_windows(arr, win, step=1):
+    """Read-only strided view of arr, one window of length win per row, every step samples. No copy."""
+    arr = np.asarray(arr)
+    n = max((len(arr) - win) // step + 1, 0)
+    return np.lib.stride_tricks.as_strided(arr, shape=(n, win), strides=(step * arr.strides[0], arr.strides[0]), writeable=False)
+
 def localmax_climb(arr, loc, hwin):
     """Climb from loc to the local maxima, up to hwin to the left/right."""
     # TODO: should be called localmax_win, since it's not really climbing but looking in a window.
-    new_loc = []
+    loc = np.asarray(loc).astype(int)
     arrp = np.pad(arr, (hwin, hwin), mode='constant')  # zero-pad
-    locp = loc + hwin
-    for lp in locp:
-        im = (lp-hwin) + np.argmax(arrp[lp-hwin:lp+hwin+1]) - hwin
-        im = min(max(im, 0), len(arr)-1)  # clip
-        new_loc.append(im)
-    return np.array(new_loc)
+    # window arr[l-hwin:l+hwin+1] is row l of the strided view, all climbed at once
+    new_loc = loc + np.argmax(sliding_windows(arrp, 2*hwin+1)[loc], axis=1) - hwin
+    return np.clip(new_loc, 0, len(arr)-1)
 
 
 def cubic_resample(series, fps_old=30, fps_new=300):